@@ -2,92 +2,266 @@
 AWS Lambda - Search Keyword Performance (Chunked Processing)
 """
 
+import csv
+import io
 import json
-import boto3
+import logging
 import os
+import re
 import tempfile
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pacsv
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from urllib.parse import unquote_plus
 
-s3_client = boto3.client('s3')
+# Lambda's root logger writes to CloudWatch; keep the hot path quiet unless LOG_LEVEL asks otherwise
+logger = logging.getLogger()
+logger.setLevel(os.environ.get('LOG_LEVEL', 'WARNING').upper())
+
+# Module-level client so warm invocations reuse pooled keep-alive connections
+s3_client = boto3.client('s3', config=Config(
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    retries={'mode': 'adaptive', 'max_attempts': 5},
+    connect_timeout=3,
+    read_timeout=30
+))
+# Multipart transfers with parallel part requests for large inputs and outputs
+transfer_config = TransferConfig(
+    multipart_threshold=8 << 20,
+    multipart_chunksize=8 << 20,
+    max_concurrency=10,
+    use_threads=True
+)
 
-SEARCH_ENGINES = ['google.com', 'www.google.com', 'bing.com', 'www.bing.com',
-                  'search.yahoo.com', 'yahoo.com', 'www.yahoo.com', 'msn.com']
+SEARCH_ENGINES = frozenset({'google.com', 'www.google.com', 'bing.com', 'www.bing.com',
+                            'search.yahoo.com', 'yahoo.com', 'www.yahoo.com', 'msn.com'})
+# Sorted so the pattern doesn't depend on set iteration order
+SEARCH_ENGINE_PATTERN = '|'.join(map(re.escape, sorted(SEARCH_ENGINES)))
+REFERRER_PATTERN = r'https?://(?P<domain>[^/]+)(?:.*?[?&][qp]=(?P<keyword>[^&]+))?'
 USECOLS = ['ip', 'referrer', 'event_list', 'product_list']
-DTYPES = {'ip': 'string', 'referrer': 'string', 'event_list': 'string', 'product_list': 'string'}
-CHUNKSIZE = 500_000
+BLOCK_SIZE = 64 << 20
+# Set to "false" when input files are not in hit time order
+ASSUME_TIME_SORTED = os.environ.get('ASSUME_TIME_SORTED', 'true').lower() != 'false'
+# Lambda allocates one vCPU per 1769 MB of memory
+WORKERS = int(os.environ.get('WORKERS', os.cpu_count() or 1))
+FIRST_SEARCH_SCHEMA = pa.schema([('ip', pa.string()), ('domain', pa.string()), ('keyword', pa.string()),
+                                 ('row', pa.int64())])
+PURCHASE_SCHEMA = pa.schema([('ip', pa.string()), ('revenue', pa.float64()), ('row', pa.int64())])
+REVENUE_SCHEMA = pa.schema([('domain', pa.string()), ('keyword', pa.string()), ('revenue', pa.float64())])
+
+
+def read_batches(input_file):
+    """Stream a TSV as record batches parsed by PyArrow's multi-threaded CSV reader."""
+    return pacsv.open_csv(
+        input_file,
+        read_options=pacsv.ReadOptions(block_size=BLOCK_SIZE),
+        parse_options=pacsv.ParseOptions(delimiter='\t'),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=USECOLS,
+            # Dictionary-encode ip so per-chunk filtering and dedup work on int32 codes
+            column_types={**{c: pa.string() for c in USECOLS}, 'ip': pa.dictionary(pa.int32(), pa.string())},
+            strings_can_be_null=True
+        )
+    )
+
+
+def parse_revenue(product_list):
+    """Parse the first product's revenue (fourth ';' field) from product_list strings."""
+    products = pa.array(product_list).fill_null('')
+    # Pad so every row has a fourth field, then cut it at the next product
+    padded = pc.binary_join_element_wise(
+        products, pa.scalar(';;;;', products.type), pa.scalar('', products.type)
+    )
+    revenue = pc.list_element(pc.split_pattern(padded, ';', max_splits=4), 3)
+    revenue = pc.list_element(pc.split_pattern(revenue, ',', max_splits=1), 0)
+    revenue = pc.if_else(pc.equal(revenue, ''), pa.scalar(None, revenue.type), revenue)
+
+    try:
+        revenue = pc.cast(revenue, pa.float64())
+    except pa.ArrowInvalid:
+        # Malformed amounts count as zero, as with pd.to_numeric(errors='coerce')
+        revenue = pa.array(pd.to_numeric(revenue.to_pandas(), errors='coerce'), type=pa.float64(), from_pandas=True)
+
+    return pc.fill_null(revenue, 0.0).to_numpy(zero_copy_only=False)
+
+
+def map_batch(batch, offset):
+    """Extract first search candidates and purchases from a batch starting at file row offset."""
+    chunk = batch.to_pandas(types_mapper={pa.string(): pd.StringDtype('pyarrow')}.get)
+    # Number rows across the whole file so searches and purchases can be ordered
+    chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+
+    # A literal engine-name scan narrows the rows the extraction regex runs on
+    referrers = chunk.loc[chunk['referrer'].str.contains(SEARCH_ENGINE_PATTERN, na=False), ['ip', 'referrer']]
+    extracted = referrers['referrer'].str.extract(REFERRER_PATTERN)
+    search_hits = pd.concat([referrers['ip'], extracted], axis=1)
+    search_hits = search_hits.loc[search_hits['domain'].isin(SEARCH_ENGINES)]
+    # Only clean keywords that survive the search engine filter
+    search_hits = search_hits.assign(keyword=(
+        search_hits['keyword']
+        .str.replace('+', ' ', regex=False)
+        .str.replace('%20', ' ', regex=False)
+        .str.lower()
+    ))
+
+    search_hits = pa.Table.from_pandas(search_hits.drop_duplicates('ip').reset_index(names='row'),
+                                       schema=FIRST_SEARCH_SCHEMA, preserve_index=False)
+
+    # Rows without events, products or any '1' can't be purchases; skip parsing them
+    candidates = chunk.loc[
+        chunk['event_list'].notna()
+        & chunk['product_list'].notna()
+        & chunk['event_list'].str.contains('1', regex=False, na=False),
+        ['ip', 'event_list', 'product_list']
+    ]
+    # Purchase means the exact token '1' appears in the comma-separated event list
+    events = candidates['event_list']
+    is_purchase = (
+        (events == '1')
+        | events.str.startswith('1,')
+        | events.str.endswith(',1')
+        | events.str.contains(',1,', regex=False)
+    )
+    purchases = candidates[['ip']].assign(revenue=parse_revenue(candidates['product_list']))
+    purchases = pa.Table.from_pandas(
+        purchases.loc[is_purchase & (purchases['revenue'] > 0)].reset_index(names='row'),
+        schema=PURCHASE_SCHEMA, preserve_index=False
+    )
+    return search_hits, purchases
+
+
+def map_batches(input_file, workers=1):
+    """Yield each batch's row count, search hits and purchases in file order."""
+    offset = 0
+    if workers <= 1:
+        for batch in read_batches(input_file):
+            yield batch.num_rows, *map_batch(batch, offset)
+            offset += batch.num_rows
+        return
+
+    # Map batches on a thread pool (the Arrow kernels release the GIL)
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch in read_batches(input_file):
+            in_flight.append((batch.num_rows, pool.submit(map_batch, batch, offset)))
+            offset += batch.num_rows
+            # Bound the number of parsed batches waiting in memory
+            if len(in_flight) > 2 * workers:
+                num_rows, future = in_flight.popleft()
+                yield num_rows, *future.result()
+        while in_flight:
+            num_rows, future = in_flight.popleft()
+            yield num_rows, *future.result()
+
+
+def write_tsv(table, output_file):
+    """Write a table as tab-separated text, quoting only the values that need it, as pandas to_csv does."""
+    needs_quoting = any(
+        pc.any(pc.match_substring_regex(column, '[\t\n\r"]')).as_py()
+        for column in table.columns if pa.types.is_string(column.type)
+    )
+    if needs_quoting:
+        # Arrow can only quote every string, so use the csv module's minimal quoting for these rare reports
+        text = io.TextIOWrapper(output_file, encoding='utf-8', newline='', write_through=True)
+        writer = csv.writer(text, delimiter='\t', lineterminator='\n')
+        writer.writerow(table.column_names)
+        writer.writerows(zip(*(column.to_pylist() for column in table.columns)))
+        text.detach()
+        return
+
+    # Arrow always quotes header names, so write the header line as plain text
+    output_file.write(('\t'.join(table.column_names) + '\n').encode())
+    pacsv.write_csv(table, output_file,
+                    pacsv.WriteOptions(include_header=False, delimiter='\t', quoting_style='none'))
 
 
 class SearchKeywordProcessor:
     """Chunked processing for large files."""
 
-    def process(self, input_file, output_file):
-        # Pass 1: Find first search referral per IP
-        first_search = {}
-
-        for chunk in pd.read_csv(input_file, sep='\t', usecols=USECOLS, dtype=DTYPES, chunksize=CHUNKSIZE):
-            chunk['domain'] = chunk['referrer'].str.extract(r'https?://([^/]+)', expand=False)
-            chunk['keyword'] = (
-                chunk['referrer']
-                .str.extract(r'[?&][qp]=([^&]+)', expand=False)
-                .str.replace('+', ' ', regex=False)
-                .str.replace('%20', ' ', regex=False)
-                .str.lower()
-            )
-            search_hits = chunk.loc[chunk['domain'].isin(SEARCH_ENGINES), ['ip', 'domain', 'keyword']]
+    @staticmethod
+    def _attribute_revenue(purchases, first_search, revenue, require_prior_search=False):
+        """Add purchase revenue to its search keyword and return the new totals and purchase count."""
+        attributed = first_search.join(purchases, 'ip', join_type='inner', left_suffix='_search')
+        if require_prior_search:
+            attributed = attributed.filter(pc.field('row') >= pc.field('row_search'))
 
-            for _, row in search_hits.iterrows():
-                if row['ip'] not in first_search:
-                    first_search[row['ip']] = (row['domain'], row['keyword'])
+        totals = (
+            pa.concat_tables([revenue, attributed.select(['domain', 'keyword', 'revenue'])])
+            .group_by(['domain', 'keyword'])
+            .aggregate([('revenue', 'sum')])
+        )
+        return totals.select(['domain', 'keyword', 'revenue_sum']).rename_columns(REVENUE_SCHEMA.names), attributed.num_rows
 
-        # Pass 2: Aggregate revenue
-        revenue = {}
+    def process(self, input_file, output_file, assume_time_sorted=True, workers=1):
+        first_search = FIRST_SEARCH_SCHEMA.empty_table()
+        revenue = REVENUE_SCHEMA.empty_table()
         total_rows = 0
         total_purchases = 0
+        unattributed_purchases = 0
 
-        for chunk in pd.read_csv(input_file, sep='\t', usecols=USECOLS, dtype=DTYPES, chunksize=CHUNKSIZE):
-            total_rows += len(chunk)
-
-            chunk['is_purchase'] = chunk['event_list'].str.contains(r'(?:^|,)1(?:,|$)', na=False, regex=True)
-            chunk['revenue'] = (
-                chunk['product_list']
-                .str.extract(r'^[^;]*;[^;]*;[^;]*;([^;,]*)', expand=False)
-                .pipe(pd.to_numeric, errors='coerce')
-                .fillna(0)
-            )
+        with tempfile.TemporaryFile(suffix='.arrow') as spill:
+            # Purchases awaiting a later search referral go to a compressed file in /tmp, not the heap
+            pending = pa.ipc.new_file(spill, PURCHASE_SCHEMA, options=pa.ipc.IpcWriteOptions(compression='zstd'))
 
-            purchases = chunk.loc[(chunk['is_purchase']) & (chunk['revenue'] > 0)]
+            # Single pass: track first search referral per IP and aggregate revenue, batch by batch in file order
+            for num_rows, search_hits, purchases in map_batches(input_file, workers):
+                total_rows += num_rows
 
-            for _, row in purchases.iterrows():
-                if row['ip'] in first_search:
-                    key = first_search[row['ip']]
-                    revenue[key] = revenue.get(key, 0) + row['revenue']
-                    total_purchases += 1
+                # Acero hashes the right side, so keep the small batch there rather than every known IP
+                new = first_search.select(['ip']).join(search_hits, 'ip', join_type='right anti')
+                first_search = pa.concat_tables([first_search, new.select(FIRST_SEARCH_SCHEMA.names)])
 
-        # Convert to DataFrame
-        result = pd.DataFrame([
-            {'Search Engine Domain': k[0], 'Search Keyword': k[1], 'Revenue': v}
-            for k, v in revenue.items()
-        ])
-        print(result)
+                if assume_time_sorted:
+                    # A purchase only counts if its IP's first search referral came before it
+                    revenue, attributed = self._attribute_revenue(purchases, first_search, revenue,
+                                                                  require_prior_search=True)
+                    unattributed_purchases += purchases.num_rows - attributed
+                else:
+                    # The search referral of an unseen IP may still appear in a later chunk
+                    revenue, attributed = self._attribute_revenue(purchases, first_search, revenue)
+                    unseen = first_search.select(['ip']).join(purchases, 'ip', join_type='right anti')
+                    pending.write_table(unseen.select(PURCHASE_SCHEMA.names))
+                total_purchases += attributed
+            pending.close()
 
-        if len(result) > 0:
-            result = result.sort_values('Revenue', ascending=False)
+            spill.seek(0)
+            reader = pa.ipc.open_file(spill)
+            for i in range(reader.num_record_batches):
+                purchases = pa.Table.from_batches([reader.get_batch(i)])
+                revenue, attributed = self._attribute_revenue(purchases, first_search, revenue)
+                total_purchases += attributed
+                unattributed_purchases += purchases.num_rows - attributed
 
-        result.to_csv(output_file, sep='\t', index=False, float_format='%.2f')
+        revenue = revenue.take(pc.sort_indices(revenue, sort_keys=[('revenue', 'descending')]))
+        formatted = pa.array([f'{value:.2f}' for value in revenue['revenue'].to_pylist()], pa.string())
+        write_tsv(pa.table([revenue['domain'], revenue['keyword'], formatted],
+                           names=['Search Engine Domain', 'Search Keyword', 'Revenue']), output_file)
 
         return {
             'rows_processed': total_rows,
             'purchases_found': total_purchases,
-            'unique_keywords': len(result),
-            'total_revenue': float(result['Revenue'].sum()) if len(result) > 0 else 0.0
+            'purchases_unattributed': unattributed_purchases,
+            'unique_keywords': revenue.num_rows,
+            'total_revenue': pc.sum(revenue['revenue']).as_py() or 0.0
         }
 
 
+# Built once per container; process() keeps its state in locals, so warm invocations can share it
+_PROCESSOR = SearchKeywordProcessor()
+
+
 def lambda_handler(event, context):
-    print("Testing NEw lambda")
-    print(f"Event: {json.dumps(event)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Event: %s", json.dumps(event))
 
     try:
         if 'Records' in event:
@@ -110,29 +284,53 @@ def lambda_handler(event, context):
             return {'statusCode': 400, 'body': json.dumps({'error': 'Invalid event'})}
 
     except Exception as e:
-        print(f"Error: {e}")
+        logger.exception("Failed to process event")
         return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
 
 
-def process_s3_file(input_bucket, input_key, output_bucket=None):
-    output_bucket = output_bucket or input_bucket
+@contextmanager
+def open_s3_stream(bucket, key):
+    """Yield a readable pipe fed by a parallel multipart download running in the background."""
+    read_fd, write_fd = os.pipe()
+
+    def download():
+        with os.fdopen(write_fd, 'wb') as writer:
+            # s3transfer writes parts in order to non-seekable outputs
+            s3_client.download_fileobj(bucket, key, writer, Config=transfer_config)
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.tsv') as tmp_in, \
-         tempfile.NamedTemporaryFile(delete=False, suffix='.tab') as tmp_out:
+    with ThreadPoolExecutor(max_workers=1) as pool, os.fdopen(read_fd, 'rb') as reader:
+        download_done = pool.submit(download)
+        try:
+            yield reader
+        except Exception as parse_error:
+            reader.close()
+            # A failed download surfaces as a parse error on the truncated stream; report the download's own
+            error = download_done.exception()
+            if error is not None and not isinstance(error, BrokenPipeError):
+                raise error from parse_error
+            raise
+        finally:
+            # Unblocks the download if parsing stopped before the end of the object
+            reader.close()
+        # A download cut on a line boundary still parses cleanly, so check it even on success
+        download_done.result()
 
-        s3_client.download_file(input_bucket, input_key, tmp_in.name)
 
-        processor = SearchKeywordProcessor()
-        stats = processor.process(tmp_in.name, tmp_out.name)
+def process_s3_file(input_bucket, input_key, output_bucket=None):
+    output_bucket = output_bucket or input_bucket
+    output = io.BytesIO()
 
-        output_key = f"output/{datetime.now().strftime('%Y-%m-%d')}_SearchKeywordPerformance.tab"
-        s3_client.upload_file(tmp_out.name, output_bucket, output_key)
+    # Parse the object as parts arrive instead of staging it in /tmp
+    with open_s3_stream(input_bucket, input_key) as body:
+        stats = _PROCESSOR.process(body, output, assume_time_sorted=ASSUME_TIME_SORTED, workers=WORKERS)
 
-        os.unlink(tmp_in.name)
-        os.unlink(tmp_out.name)
+    # The report is one row per keyword, so a single request beats a multipart upload
+    output_key = f"output/{datetime.now().strftime('%Y-%m-%d')}_SearchKeywordPerformance.tab"
+    s3_client.put_object(Bucket=output_bucket, Key=output_key, Body=output.getvalue(),
+                         ContentType='text/tab-separated-values')
 
-        return {
-            'input': f"s3://{input_bucket}/{input_key}",
-            'output': f"s3://{output_bucket}/{output_key}",
-            **stats
-        }
+    return {
+        'input': f"s3://{input_bucket}/{input_key}",
+        'output': f"s3://{output_bucket}/{output_key}",
+        **stats
+    }
@@ -1,107 +1,229 @@
 """
 Search Keyword Performance - Chunked Processing
 
-Handles large files (10GB+) using two-pass chunked processing.
+Handles large files (10GB+) using single-pass chunked processing.
 """
 
 import argparse
+import logging
+import os
+import re
+import tempfile
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pacsv
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
 
 class SearchKeywordProcessor:
     """Processes hit-level data to analyze search keyword revenue performance."""
 
-    SEARCH_ENGINES = ['google.com', 'www.google.com', 'bing.com', 'www.bing.com',
-                      'search.yahoo.com', 'yahoo.com', 'www.yahoo.com', 'msn.com']
+    SEARCH_ENGINES = frozenset({'google.com', 'www.google.com', 'bing.com', 'www.bing.com',
+                                'search.yahoo.com', 'yahoo.com', 'www.yahoo.com', 'msn.com'})
+    # Sorted so the pattern doesn't depend on set iteration order
+    SEARCH_ENGINE_PATTERN = '|'.join(map(re.escape, sorted(SEARCH_ENGINES)))
+    REFERRER_PATTERN = r'https?://(?P<domain>[^/]+)(?:.*?[?&][qp]=(?P<keyword>[^&]+))?'
     USECOLS = ['ip', 'referrer', 'event_list', 'product_list']
-    DTYPES = {'ip': 'string', 'referrer': 'string', 'event_list': 'string', 'product_list': 'string'}
-    CHUNKSIZE = 500_000
+    BLOCK_SIZE = 64 << 20
+    FIRST_SEARCH_SCHEMA = pa.schema([('ip', pa.string()), ('domain', pa.string()), ('keyword', pa.string()),
+                                     ('row', pa.int64())])
+    PURCHASE_SCHEMA = pa.schema([('ip', pa.string()), ('revenue', pa.float64()), ('row', pa.int64())])
+    REVENUE_SCHEMA = pa.schema([('domain', pa.string()), ('keyword', pa.string()), ('revenue', pa.float64())])
 
-    def __init__(self, input_file):
+    def __init__(self, input_file, assume_time_sorted=True, workers=1):
         self.input_file = input_file
-        self.first_search = {}
-        self.revenue = {}
+        self.assume_time_sorted = assume_time_sorted
+        self.workers = workers
+        self.first_search = self.FIRST_SEARCH_SCHEMA.empty_table()
+        self.revenue = self.REVENUE_SCHEMA.empty_table()
         self.total_rows = 0
         self.total_purchases = 0
+        self.unattributed_purchases = 0
+
+    def _read_batches(self):
+        """Stream the file as record batches parsed by PyArrow's multi-threaded CSV reader."""
+        return pacsv.open_csv(
+            self.input_file,
+            read_options=pacsv.ReadOptions(block_size=self.BLOCK_SIZE),
+            parse_options=pacsv.ParseOptions(delimiter='\t'),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=self.USECOLS,
+                # Dictionary-encode ip so per-chunk filtering and dedup work on int32 codes
+                column_types={**{c: pa.string() for c in self.USECOLS}, 'ip': pa.dictionary(pa.int32(), pa.string())},
+                strings_can_be_null=True
+            )
+        )
+
+    @classmethod
+    def _map_batch(cls, batch, offset):
+        """Extract first search candidates and purchases from a batch starting at file row offset."""
+        chunk = batch.to_pandas(types_mapper={pa.string(): pd.StringDtype('pyarrow')}.get)
+        # Number rows across the whole file so searches and purchases can be ordered
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))
 
-    def _extract_search_info(self, chunk):
-        """Extract domain and keyword from referrer."""
-        chunk['domain'] = chunk['referrer'].str.extract(r'https?://([^/]+)', expand=False)
-        chunk['keyword'] = (
-            chunk['referrer']
-            .str.extract(r'[?&][qp]=([^&]+)', expand=False)
+        search_hits = pa.Table.from_pandas(cls._extract_search_info(chunk).drop_duplicates('ip').reset_index(names='row'),
+                                           schema=cls.FIRST_SEARCH_SCHEMA, preserve_index=False)
+        purchases = pa.Table.from_pandas(cls._extract_purchases(chunk).reset_index(names='row'),
+                                         schema=cls.PURCHASE_SCHEMA, preserve_index=False)
+        return search_hits, purchases
+
+    @classmethod
+    def _extract_search_info(cls, chunk):
+        """Extract search engine hits with domain and keyword from referrer."""
+        # A literal engine-name scan narrows the rows the extraction regex runs on
+        referrers = chunk.loc[chunk['referrer'].str.contains(cls.SEARCH_ENGINE_PATTERN, na=False),
+                              ['ip', 'referrer']]
+        extracted = referrers['referrer'].str.extract(cls.REFERRER_PATTERN)
+        search_hits = pd.concat([referrers['ip'], extracted], axis=1)
+        search_hits = search_hits.loc[search_hits['domain'].isin(cls.SEARCH_ENGINES)]
+
+        # Only clean keywords that survive the search engine filter
+        return search_hits.assign(keyword=(
+            search_hits['keyword']
             .str.replace('+', ' ', regex=False)
             .str.replace('%20', ' ', regex=False)
             .str.lower()
+        ))
+
+    @staticmethod
+    def _parse_revenue(product_list):
+        """Parse the first product's revenue (fourth ';' field) from product_list strings."""
+        products = pa.array(product_list).fill_null('')
+        # Pad so every row has a fourth field, then cut it at the next product
+        padded = pc.binary_join_element_wise(
+            products, pa.scalar(';;;;', products.type), pa.scalar('', products.type)
         )
-        return chunk
-
-    def _extract_revenue(self, chunk):
-        """Extract purchase flag and revenue from chunk."""
-        chunk['is_purchase'] = chunk['event_list'].str.contains(r'(?:^|,)1(?:,|$)', na=False, regex=True)
-        chunk['revenue'] = (
-            chunk['product_list']
-            .str.extract(r'^[^;]*;[^;]*;[^;]*;([^;,]*)', expand=False)
-            .pipe(pd.to_numeric, errors='coerce')
-            .fillna(0)
+        revenue = pc.list_element(pc.split_pattern(padded, ';', max_splits=4), 3)
+        revenue = pc.list_element(pc.split_pattern(revenue, ',', max_splits=1), 0)
+        revenue = pc.if_else(pc.equal(revenue, ''), pa.scalar(None, revenue.type), revenue)
+
+        try:
+            revenue = pc.cast(revenue, pa.float64())
+        except pa.ArrowInvalid:
+            # Malformed amounts count as zero, as with pd.to_numeric(errors='coerce')
+            revenue = pa.array(pd.to_numeric(revenue.to_pandas(), errors='coerce'), type=pa.float64(), from_pandas=True)
+
+        return pc.fill_null(revenue, 0.0).to_numpy(zero_copy_only=False)
+
+    @classmethod
+    def _extract_purchases(cls, chunk):
+        """Extract purchase rows with positive revenue from chunk."""
+        # Rows without events, products or any '1' can't be purchases; skip parsing them
+        candidates = chunk.loc[
+            chunk['event_list'].notna()
+            & chunk['product_list'].notna()
+            & chunk['event_list'].str.contains('1', regex=False, na=False),
+            ['ip', 'event_list', 'product_list']
+        ]
+
+        # Purchase means the exact token '1' appears in the comma-separated event list
+        events = candidates['event_list']
+        is_purchase = (
+            (events == '1')
+            | events.str.startswith('1,')
+            | events.str.endswith(',1')
+            | events.str.contains(',1,', regex=False)
         )
-        return chunk
+        purchases = candidates[['ip']].assign(revenue=cls._parse_revenue(candidates['product_list']))
+        return purchases.loc[is_purchase & (purchases['revenue'] > 0)]
 
-    def _pass1_find_search_referrals(self):
-        """Pass 1: Find first search referral per IP."""
-        print("Pass 1: Finding first search referrals...")
+    def _update_first_search(self, search_hits):
+        """Record the first search referral for each IP not seen before."""
+        # Acero hashes the right side, so keep the small batch there rather than every known IP
+        new = self.first_search.select(['ip']).join(search_hits, 'ip', join_type='right anti')
+        self.first_search = pa.concat_tables([self.first_search, new.select(self.FIRST_SEARCH_SCHEMA.names)])
+
+    def _attribute_revenue(self, purchases, require_prior_search=False):
+        """Add purchase revenue to its search keyword and return the number of purchases attributed."""
+        attributed = self.first_search.join(purchases, 'ip', join_type='inner', left_suffix='_search')
+        if require_prior_search:
+            attributed = attributed.filter(pc.field('row') >= pc.field('row_search'))
+
+        totals = (
+            pa.concat_tables([self.revenue, attributed.select(['domain', 'keyword', 'revenue'])])
+            .group_by(['domain', 'keyword'])
+            .aggregate([('revenue', 'sum')])
+        )
+        self.revenue = totals.select(['domain', 'keyword', 'revenue_sum']).rename_columns(self.REVENUE_SCHEMA.names)
+        self.total_purchases += attributed.num_rows
 
-        for chunk in pd.read_csv(self.input_file, sep='\t', usecols=self.USECOLS,
-                                  dtype=self.DTYPES, chunksize=self.CHUNKSIZE):
-            chunk = self._extract_search_info(chunk)
-            search_hits = chunk.loc[chunk['domain'].isin(self.SEARCH_ENGINES), ['ip', 'domain', 'keyword']]
+        return attributed.num_rows
 
-            for _, row in search_hits.iterrows():
-                if row['ip'] not in self.first_search:
-                    self.first_search[row['ip']] = (row['domain'], row['keyword'])
+    def _map_batches(self):
+        """Yield each batch's row count, search hits and purchases in file order."""
+        offset = 0
+        if self.workers <= 1:
+            for batch in self._read_batches():
+                yield batch.num_rows, *self._map_batch(batch, offset)
+                offset += batch.num_rows
+            return
 
-        print(f"  Found {len(self.first_search)} users from search engines")
+        in_flight = deque()
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for batch in self._read_batches():
+                in_flight.append((batch.num_rows, pool.submit(self._map_batch, batch, offset)))
+                offset += batch.num_rows
+                # Bound the number of parsed batches waiting in memory
+                if len(in_flight) > 2 * self.workers:
+                    num_rows, future = in_flight.popleft()
+                    yield num_rows, *future.result()
+            while in_flight:
+                num_rows, future = in_flight.popleft()
+                yield num_rows, *future.result()
 
-    def _pass2_aggregate_revenue(self):
-        """Pass 2: Aggregate revenue by search keyword."""
-        print("Pass 2: Aggregating revenue...")
+    def _process_batches(self):
+        """Attribute purchases batch by batch in file order as mapped batches arrive."""
+        with tempfile.TemporaryFile(suffix='.arrow') as spill:
+            # Purchases awaiting a later search referral go to a compressed file, not the heap
+            pending = pa.ipc.new_file(spill, self.PURCHASE_SCHEMA,
+                                      options=pa.ipc.IpcWriteOptions(compression='zstd'))
 
-        for chunk in pd.read_csv(self.input_file, sep='\t', usecols=self.USECOLS,
-                                  dtype=self.DTYPES, chunksize=self.CHUNKSIZE):
-            self.total_rows += len(chunk)
-            chunk = self._extract_revenue(chunk)
-            purchases = chunk.loc[(chunk['is_purchase']) & (chunk['revenue'] > 0)]
+            for num_rows, search_hits, purchases in self._map_batches():
+                self.total_rows += num_rows
+                self._update_first_search(search_hits)
 
-            for _, row in purchases.iterrows():
-                if row['ip'] in self.first_search:
-                    key = self.first_search[row['ip']]
-                    self.revenue[key] = self.revenue.get(key, 0) + row['revenue']
-                    self.total_purchases += 1
+                if self.assume_time_sorted:
+                    # A purchase only counts if its IP's first search referral came before it
+                    attributed = self._attribute_revenue(purchases, require_prior_search=True)
+                    self.unattributed_purchases += purchases.num_rows - attributed
+                else:
+                    # The search referral of an unseen IP may still appear in a later chunk
+                    self._attribute_revenue(purchases)
+                    unseen = self.first_search.select(['ip']).join(purchases, 'ip', join_type='right anti')
+                    pending.write_table(unseen.select(self.PURCHASE_SCHEMA.names))
+            pending.close()
 
-        print(f"  Processed {self.total_rows:,} rows, {self.total_purchases} purchases")
+            spill.seek(0)
+            reader = pa.ipc.open_file(spill)
+            for i in range(reader.num_record_batches):
+                purchases = pa.Table.from_batches([reader.get_batch(i)])
+                self.unattributed_purchases += purchases.num_rows - self._attribute_revenue(purchases)
 
     def process(self):
-        """Process file using two-pass chunked approach."""
-        self._pass1_find_search_referrals()
-        self._pass2_aggregate_revenue()
+        """Process file in a single chunked pass."""
+        logger.info("Processing chunks...")
+        self._process_batches()
 
-        result = pd.DataFrame([
-            {'Search Engine Domain': k[0], 'Search Keyword': k[1], 'Revenue': v}
-            for k, v in self.revenue.items()
-        ])
-        print("REsult is :")
-        print(result)
+        logger.info("  Found %d users from search engines", self.first_search.num_rows)
+        logger.info("  Processed %s rows, %d purchases", f"{self.total_rows:,}", self.total_purchases)
+        logger.info("  Skipped %d purchases without a search referral", self.unattributed_purchases)
 
-        return result.sort_values('Revenue', ascending=False) if len(result) > 0 else result
+        ranked = self.revenue.take(pc.sort_indices(self.revenue, sort_keys=[('revenue', 'descending')]))
+        return ranked.rename_columns(['Search Engine Domain', 'Search Keyword', 'Revenue']).to_pandas()
 
     def get_stats(self):
         """Return processing statistics."""
         return {
             'rows_processed': self.total_rows,
             'purchases_found': self.total_purchases,
-            'unique_keywords': len(self.revenue),
-            'total_revenue': sum(self.revenue.values())
+            'purchases_unattributed': self.unattributed_purchases,
+            'unique_keywords': self.revenue.num_rows,
+            'total_revenue': pc.sum(self.revenue['revenue']).as_py() or 0.0
         }
 
 
@@ -109,9 +231,15 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('input_file')
     parser.add_argument('-o', '--output', default=None)
+    parser.add_argument('--unsorted', action='store_true',
+                        help='Input is not in hit time order; attribute purchases made before the search referral')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of worker processes; 1 processes chunks sequentially')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log processing progress')
     args = parser.parse_args()
 
-    processor = SearchKeywordProcessor(args.input_file)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(message)s')
+    processor = SearchKeywordProcessor(args.input_file, assume_time_sorted=not args.unsorted, workers=args.workers)
 
     result = processor.process()
 
@@ -0,0 +1,122 @@
+"""
+Unit tests for the Search Keyword Performance Lambda handler
+"""
+
+import io
+import json
+import os
+import unittest
+from unittest import mock
+import pyarrow as pa
+from botocore.exceptions import ClientError
+import lambda_handler
+
+
+SAMPLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data.sql')
+HEADER = b"hit_time_gmt\tdate_time\tuser_agent\tip\tevent_list\tgeo_city\tgeo_region\tgeo_country\tpagename\tpage_url\tproduct_list\treferrer\n"
+
+
+class TestLambdaHandler(unittest.TestCase):
+    """Test cases for processing an S3 object end to end."""
+
+    def test_sample_file_report_and_stats(self):
+        """Test that the sample file gives the same report and stats with and without workers."""
+        with open(SAMPLE_FILE, 'rb') as f:
+            raw = f.read()
+
+        def download_fileobj(bucket, key, fileobj, Config=None):
+            fileobj.write(raw)
+
+        # The small block size splits the sample into several batches
+        for workers, block_size in [(1, lambda_handler.BLOCK_SIZE), (1, 1024), (3, 1024)]:
+            with self.subTest(workers=workers, block_size=block_size):
+                s3 = mock.Mock()
+                s3.download_fileobj.side_effect = download_fileobj
+
+                with mock.patch.object(lambda_handler, 's3_client', s3), \
+                        mock.patch.object(lambda_handler, 'WORKERS', workers), \
+                        mock.patch.object(lambda_handler, 'BLOCK_SIZE', block_size):
+                    response = lambda_handler.lambda_handler({'input_bucket': 'bucket', 'input_key': 'input/data.tsv'},
+                                                             None)
+
+                self.assertEqual(response['statusCode'], 200)
+                result = json.loads(response['body'])['result']
+                self.assertEqual(result['rows_processed'], 21)
+                self.assertEqual(result['purchases_found'], 3)
+                self.assertEqual(result['purchases_unattributed'], 0)
+                self.assertEqual(result['unique_keywords'], 2)
+                self.assertEqual(result['total_revenue'], 730.0)
+
+                upload = s3.put_object.call_args.kwargs
+                self.assertEqual(upload['Bucket'], 'bucket')
+                self.assertEqual(result['output'], f"s3://bucket/{upload['Key']}")
+                self.assertEqual(upload['Body'],
+                                 b"Search Engine Domain\tSearch Keyword\tRevenue\n"
+                                 b"www.google.com\tipod\t480.00\n"
+                                 b"www.bing.com\tzune\t250.00\n")
+
+
+class TestS3Stream(unittest.TestCase):
+    """Test cases for streaming the input object from S3."""
+
+    def test_missing_object_reports_client_error(self):
+        """Test that a download failing before any data arrives reports the S3 error, not a CSV error."""
+        s3 = mock.Mock()
+        s3.download_fileobj.side_effect = ClientError(
+            {'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'}}, 'GetObject')
+
+        with mock.patch.object(lambda_handler, 's3_client', s3):
+            response = lambda_handler.lambda_handler({'input_bucket': 'bucket', 'input_key': 'input/data.tsv'}, None)
+
+        self.assertEqual(response['statusCode'], 500)
+        self.assertIn('NoSuchKey', json.loads(response['body'])['error'])
+        s3.put_object.assert_not_called()
+
+    def test_download_dropped_mid_row_reports_download_error(self):
+        """Test that a download cut off inside a row reports the download error."""
+        def download_fileobj(bucket, key, fileobj, Config=None):
+            fileobj.write(HEADER + b"1254033280\t2009-09-27\tMozilla\t1.1.1.1")
+            raise ConnectionError('Connection reset by peer')
+
+        s3 = mock.Mock()
+        s3.download_fileobj.side_effect = download_fileobj
+
+        with mock.patch.object(lambda_handler, 's3_client', s3):
+            with self.assertRaises(ConnectionError):
+                lambda_handler.process_s3_file('bucket', 'input/data.tsv')
+        s3.put_object.assert_not_called()
+
+
+class TestWriteTsv(unittest.TestCase):
+    """Test cases for writing the keyword report."""
+
+    def write(self, table):
+        """Return the bytes write_tsv produces for table."""
+        output = io.BytesIO()
+        lambda_handler.write_tsv(table, output)
+        return output.getvalue()
+
+    def test_plain_values_unquoted(self):
+        """Test that values without structural characters are written without quotes."""
+        table = pa.table({'Search Engine Domain': ['www.google.com', 'www.bing.com'],
+                          'Search Keyword': ['ipod', None],
+                          'Revenue': ['290.00', '250.00']})
+        self.assertEqual(self.write(table),
+                         b"Search Engine Domain\tSearch Keyword\tRevenue\n"
+                         b"www.google.com\tipod\t290.00\n"
+                         b"www.bing.com\t\t250.00\n")
+
+    def test_only_values_with_quotes_are_quoted(self):
+        """Test that a keyword containing a quote is quoted the way pandas to_csv quotes it."""
+        table = pa.table({'Search Engine Domain': ['www.google.com', 'www.bing.com'],
+                          'Search Keyword': ['say "hi"', 'zune'],
+                          'Revenue': ['1.00', '2.00']})
+        self.assertEqual(self.write(table),
+                         b"Search Engine Domain\tSearch Keyword\tRevenue\n"
+                         b'www.google.com\t"say ""hi"""\t1.00\n'
+                         b"www.bing.com\tzune\t2.00\n")
+        self.assertEqual(self.write(table), table.to_pandas().to_csv(sep='\t', index=False).encode())
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -6,6 +6,8 @@ import unittest
 import tempfile
 import os
 import pandas as pd
+import pyarrow as pa
+from unittest import mock
 from search_keyword_performance import SearchKeywordProcessor
 
 
@@ -82,6 +84,40 @@ class TestSearchKeywordProcessor(unittest.TestCase):
         self.assertEqual(stats['unique_keywords'], 2)
         self.assertEqual(stats['total_revenue'], 540.0)
 
+    def test_parallel_matches_sequential(self):
+        """Test that processing on a worker pool gives the same results and stats."""
+        sequential = SearchKeywordProcessor(self.temp_file.name)
+        parallel = SearchKeywordProcessor(self.temp_file.name, workers=2)
+        pd.testing.assert_frame_equal(sequential.process().reset_index(drop=True),
+                                      parallel.process().reset_index(drop=True))
+        self.assertEqual(sequential.get_stats(), parallel.get_stats())
+
+    def test_parallel_matches_sequential_across_batches(self):
+        """Test that the parallel reduce keeps each IP's earliest search when it spans batches."""
+        data = """hit_time_gmt\tdate_time\tuser_agent\tip\tevent_list\tgeo_city\tgeo_region\tgeo_country\tpagename\tpage_url\tproduct_list\treferrer
+1254033280\t2009-09-27\tMozilla\t1.1.1.1\t\tCity\tST\tUS\tHome\thttp://site.com\t\thttp://www.google.com/search?q=first
+1254033380\t2009-09-27\tMozilla\t1.1.1.1\t\tCity\tST\tUS\tHome\thttp://site.com\t\thttp://www.bing.com/search?q=second
+1254033480\t2009-09-27\tMozilla\t1.1.1.1\t1\tCity\tST\tUS\tComplete\thttp://site.com\tCat;Prod;1;100;\thttp://site.com"""
+
+        temp = tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.tsv')
+        temp.write(data)
+        temp.close()
+
+        try:
+            # A block only fits one row, so each hit lands in its own batch
+            with mock.patch.object(SearchKeywordProcessor, 'BLOCK_SIZE', 128):
+                sequential = SearchKeywordProcessor(temp.name)
+                self.assertEqual(len(list(sequential._read_batches())), 3)
+                parallel = SearchKeywordProcessor(temp.name, workers=2)
+                expected = sequential.process().reset_index(drop=True)
+                pd.testing.assert_frame_equal(expected, parallel.process().reset_index(drop=True))
+
+            self.assertEqual(sequential.get_stats(), parallel.get_stats())
+            self.assertEqual(expected['Search Keyword'].values[0], 'first')
+            self.assertEqual(expected['Revenue'].values[0], 100.0)
+        finally:
+            os.unlink(temp.name)
+
     def test_non_search_engine_referrer_ignored(self):
         """Test that internal referrers are ignored."""
         data = """hit_time_gmt\tdate_time\tuser_agent\tip\tevent_list\tgeo_city\tgeo_region\tgeo_country\tpagename\tpage_url\tproduct_list\treferrer
@@ -133,6 +169,75 @@ class TestSearchKeywordProcessor(unittest.TestCase):
         finally:
             os.unlink(temp.name)
 
+    def test_purchase_before_search_referral_skipped(self):
+        """Test that a purchase made before the IP's search referral is not attributed."""
+        data = """hit_time_gmt\tdate_time\tuser_agent\tip\tevent_list\tgeo_city\tgeo_region\tgeo_country\tpagename\tpage_url\tproduct_list\treferrer
+1254033280\t2009-09-27\tMozilla\t1.1.1.1\t1\tCity\tST\tUS\tComplete\thttp://site.com\tCat;Prod;1;100;\thttp://site.com
+1254033380\t2009-09-27\tMozilla\t1.1.1.1\t\tCity\tST\tUS\tHome\thttp://site.com\t\thttp://www.google.com/search?q=test"""
+
+        temp = tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.tsv')
+        temp.write(data)
+        temp.close()
+
+        try:
+            processor = SearchKeywordProcessor(temp.name)
+            result = processor.process()
+            self.assertEqual(len(result), 0)
+            self.assertEqual(processor.get_stats()['purchases_unattributed'], 1)
+
+            processor = SearchKeywordProcessor(temp.name, assume_time_sorted=False)
+            result = processor.process()
+            self.assertEqual(result['Revenue'].values[0], 100.0)
+            self.assertEqual(processor.get_stats()['purchases_unattributed'], 0)
+        finally:
+            os.unlink(temp.name)
+
+    def test_unsorted_purchase_in_earlier_batch_attributed(self):
+        """Test that an unsorted purchase spilled to disk is attributed to a later batch's search, with and without workers."""
+        data = """hit_time_gmt\tdate_time\tuser_agent\tip\tevent_list\tgeo_city\tgeo_region\tgeo_country\tpagename\tpage_url\tproduct_list\treferrer
+1254033280\t2009-09-27\tMozilla\t1.1.1.1\t1\tCity\tST\tUS\tComplete\thttp://site.com\tCat;Prod;1;100;\thttp://site.com
+1254033380\t2009-09-27\tMozilla\t2.2.2.2\t\tCity\tST\tUS\tHome\thttp://site.com\t\thttp://site.com
+1254033480\t2009-09-27\tMozilla\t1.1.1.1\t\tCity\tST\tUS\tHome\thttp://site.com\t\thttp://www.google.com/search?q=test"""
+
+        temp = tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.tsv')
+        temp.write(data)
+        temp.close()
+
+        open_file = pa.ipc.open_file
+        spilled_rows = []
+
+        def open_spill(source):
+            reader = open_file(source)
+            spilled_rows.append(reader.read_all().num_rows)
+            return reader
+
+        try:
+            for workers in (1, 2):
+                with self.subTest(workers=workers):
+                    spilled_rows.clear()
+                    # A block only fits one row, so the purchase is read before its search
+                    with mock.patch.object(SearchKeywordProcessor, 'BLOCK_SIZE', 128), \
+                            mock.patch.object(pa.ipc, 'open_file', open_spill):
+                        processor = SearchKeywordProcessor(temp.name, assume_time_sorted=False, workers=workers)
+                        self.assertEqual(len(list(processor._read_batches())), 3)
+                        result = processor.process()
+
+                    self.assertEqual(spilled_rows, [1])
+                    self.assertEqual(result['Revenue'].values[0], 100.0)
+                    self.assertEqual(processor.get_stats()['purchases_found'], 1)
+                    self.assertEqual(processor.get_stats()['purchases_unattributed'], 0)
+        finally:
+            os.unlink(temp.name)
+
+    def test_revenue_parsing_edge_cases(self):
+        """Test revenue is read from the first product and malformed amounts count as zero."""
+        product_list = pd.Series(
+            ['Cat;Prod;1;250;', 'Cat;Prod;1;;', None, 'Cat;Prod', 'Cat;A;1;100,Cat;B;1;50;', 'Cat;Prod;1;abc;'],
+            dtype=pd.StringDtype('pyarrow')
+        )
+        revenue = SearchKeywordProcessor._parse_revenue(product_list)
+        self.assertListEqual(list(revenue), [250.0, 0.0, 0.0, 0.0, 100.0, 0.0])
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)